@@ -1,89 +1,34 @@
 import streamlit as st
-import pandas as pd
 import joblib
 import os
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from pipeline import (
+    DATA_FILE,
+    PARTITION_BY_COUNTRY,
+    SIMILARITY_INDEX_FILE,
+    build_artifacts,
+    published_files,
+    read_similarity,
+    recommend_products,
+    stale_artifacts
+)
 
 # =====================================================
 # ✅ MUST BE FIRST STREAMLIT COMMAND
 # =====================================================
 st.set_page_config(page_title="Shopper Spectrum", layout="wide")
 
-# =====================================================
-# AUTO-CREATE PIVOT TABLE & SIMILARITY (ONLY IF MISSING)
-# =====================================================
-def build_recommendation_files():
-    df = pd.read_csv("online_retail.csv")
-
-    df = df.dropna(subset=["CustomerID", "Description", "Quantity"])
-
-    pivot_table = pd.pivot_table(
-        df,
-        index="CustomerID",
-        columns="Description",
-        values="Quantity",
-        aggfunc="sum",
-        fill_value=0
-    )
-
-    similarity_matrix = cosine_similarity(pivot_table.T)
-
-    similarity_df = pd.DataFrame(
-        similarity_matrix,
-        index=pivot_table.columns,
-        columns=pivot_table.columns
-    )
-
-    joblib.dump(pivot_table, "pivot_table.pkl")
-    joblib.dump(similarity_df, "similarity_df.pkl")
-
-
-def build_segmentation_files():
-    df = pd.read_csv("online_retail.csv")
-    df["InvoiceDate"] = pd.to_datetime(df["InvoiceDate"])
-
-    rfm = df.groupby("CustomerID").agg({
-        "InvoiceDate": lambda x: (df["InvoiceDate"].max() - x.max()).days,
-        "InvoiceNo": "count",
-        "Quantity": "sum"
-    })
-
-    rfm.columns = ["Recency", "Frequency", "Monetary"]
-
-    scaler = StandardScaler()
-    rfm_scaled = scaler.fit_transform(rfm)
-
-    kmeans = KMeans(n_clusters=5, random_state=42)
-    kmeans.fit(rfm_scaled)
-
-    segment_map = {
-        0: "Champions",
-        1: "Loyal Customers",
-        2: "Potential Loyalists",
-        3: "At Risk",
-        4: "Hibernating"
-    }
+# Markets kept in memory at once when similarity is partitioned by country.
+MAX_CACHED_MARKETS = int(os.environ.get("SHOPPER_MAX_CACHED_MARKETS", "4"))
 
-    joblib.dump(kmeans, "kmeans_rfm_model.pkl")
-    joblib.dump(scaler, "rfm_scaler.pkl")
-    joblib.dump(segment_map, "segment_map.pkl")
-
-
-required_files = [
-    "pivot_table.pkl",
-    "similarity_df.pkl",
-    "kmeans_rfm_model.pkl",
-    "rfm_scaler.pkl",
-    "segment_map.pkl"
-]
+required_files = list(published_files())
 
 # ✅ NOW SAFE — set_page_config already called
-if not all(os.path.exists(f) for f in required_files):
-    with st.spinner("🚀 Initializing models for first run..."):
-        build_recommendation_files()
-        build_segmentation_files()
+# Prebuilt models can be deployed without the raw CSV; only rebuild with it.
+models_rebuilt = False
+if os.path.exists(DATA_FILE) or not all(os.path.exists(f) for f in required_files):
+    if stale_artifacts():
+        with st.spinner("🚀 Rebuilding stale models..."):
+            models_rebuilt = build_artifacts()
 
 # =====================================================
 # 🔥 FULL ADVANCED 3D + GLASSMORPHIC CSS
@@ -489,22 +434,34 @@ def load_models():
 
 @st.cache_data
 def load_recommendation_data():
-    return (
-        joblib.load("pivot_table.pkl"),
-        joblib.load("similarity_df.pkl")
-    )
+    return joblib.load("pivot_table.pkl")
 
-kmeans, scaler, segment_map = load_models()
-pivot_table, similarity_df = load_recommendation_data()
+# Shared, not copied per session: scores are dequantized per query column.
+@st.cache_resource
+def load_similarity():
+    return read_similarity("similarity_df.pkl")
 
-# =====================================================
-# RECOMMENDATION FUNCTION
-# =====================================================
-def recommend_products(product_name, similarity_df, top_n=5):
-    if product_name not in similarity_df.columns:
-        return None
-    scores = similarity_df[product_name].sort_values(ascending=False)
-    return scores.iloc[1:top_n + 1].index.tolist()
+@st.cache_resource
+def load_similarity_index():
+    return joblib.load(SIMILARITY_INDEX_FILE)
+
+# Bounded LRU: resident memory tracks the markets in use, not the catalog.
+@st.cache_resource(max_entries=MAX_CACHED_MARKETS)
+def load_market_similarity(country):
+    return read_similarity(load_similarity_index()[country])
+
+# Cached loaders are process-wide; drop them so every session sees the rebuild.
+if models_rebuilt:
+    for loader in (load_models, load_recommendation_data, load_similarity,
+                   load_similarity_index, load_market_similarity):
+        loader.clear()
+
+kmeans, scaler, segment_map = load_models()
+if PARTITION_BY_COUNTRY:
+    similarity_index = load_similarity_index()
+else:
+    pivot_table = load_recommendation_data()
+    similarity_df = load_similarity()
 
 # =====================================================
 # ENHANCED 3D UI
@@ -544,6 +501,10 @@ with tab1:
     
     st.markdown("---")
     
+    if PARTITION_BY_COUNTRY:
+        market = st.selectbox("🌍 Market", sorted(similarity_index))
+        similarity_df = load_market_similarity(market)
+
     # Input section with label
     st.markdown("<p style='color: #a0a0ff; font-size: 1.1em; margin-bottom: 10px;'>Enter a product name to get similar recommendations:</p>", unsafe_allow_html=True)
     
@@ -696,6 +657,10 @@ with st.sidebar:
     st.markdown("• Higher Frequency = More purchases")
     st.markdown("• Higher Monetary = More spending")
 
+    agreement = getattr(similarity_df, "agreement", None)
+    if agreement is not None:
+        st.caption(f"Similarity scores: {similarity_df.dtype} • Top-5 agreement vs float64: {agreement:.1%}")
+
     st.markdown("""
     **⚠️ Dataset Notice**
 
@@ -0,0 +1,491 @@
+"""Offline build pipeline and similarity readers for the Shopper Spectrum models.
+
+Kept out of app.py so the build state (and its lock) lives once per process
+instead of being re-executed on every Streamlit rerun.
+"""
+import os
+import re
+import hashlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import numpy as np
+import joblib
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import StandardScaler
+from sklearn.cluster import KMeans
+
+# =====================================================
+# SIMILARITY PARTITIONING (PER-COUNTRY MARKETS)
+# =====================================================
+# When enabled, one similarity matrix is built per `Country` in parallel
+# workers and the app only loads the markets that are actually browsed.
+PARTITION_BY_COUNTRY = os.environ.get("SHOPPER_PARTITION_BY_COUNTRY", "0") == "1"
+SIMILARITY_INDEX_FILE = "similarity_index.pkl"
+PARTITION_DIR = "similarity_by_country"
+
+# =====================================================
+# SIMILARITY ARTIFACT STORAGE (QUANTIZED SCORES)
+# =====================================================
+# Scores are stored as float64, float16 or scaled int8; ranking only needs
+# relative order, and the build reports how much top-5 overlap survives.
+# Uncompressed artifacts are memory-mapped so only queried rows are paged in;
+# any SHOPPER_SIMILARITY_COMPRESS level > 0 forces a full load instead.
+SIMILARITY_DTYPE = os.environ.get("SHOPPER_SIMILARITY_DTYPE", "float16")
+SIMILARITY_COMPRESS = int(os.environ.get("SHOPPER_SIMILARITY_COMPRESS", "0"))
+SIMILARITY_DTYPES = ("float64", "float16", "int8")
+
+# =====================================================
+# PIVOT TABLE & SIMILARITY
+# =====================================================
+def build_pivot_table(df):
+    return pd.pivot_table(
+        df,
+        index="CustomerID",
+        columns="Description",
+        values="Quantity",
+        aggfunc="sum",
+        fill_value=0
+    )
+
+
+def compute_similarity(pivot_table):
+    similarity_matrix = cosine_similarity(pivot_table.T)
+
+    similarity_df = pd.DataFrame(
+        similarity_matrix,
+        index=pivot_table.columns,
+        columns=pivot_table.columns
+    )
+
+    return similarity_df
+
+
+def quantize_similarity(similarity_df, dtype=SIMILARITY_DTYPE):
+    if dtype not in SIMILARITY_DTYPES:
+        raise ValueError(f"Unsupported similarity dtype: {dtype!r}")
+
+    scores = similarity_df.to_numpy()
+    scale = 1.0
+    if dtype == "int8":
+        scale = float(np.abs(scores).max()) / 127 or 1.0
+        scores = np.round(scores / scale).astype(np.int8)
+    else:
+        scores = scores.astype(dtype)
+
+    return {
+        "labels": similarity_df.columns,
+        "scores": scores,
+        "scale": scale,
+        "dtype": dtype
+    }
+
+
+def ranking_agreement(similarity_df, artifact, top_n=5, chunk_size=512):
+    # Mean overlap between the float64 and quantized top-N lists, ranked the
+    # same way as recommend_products: the product itself is excluded (its
+    # quantized self-score can tie with near-duplicates) and ties keep
+    # catalog order. The matrix is symmetric, so row i holds column i.
+    reference = similarity_df.to_numpy()
+    scores = artifact["scores"]
+    overlap = total = 0
+    for start in range(0, len(reference), chunk_size):
+        stop = start + chunk_size
+        ref_block = reference[start:stop].astype(np.float64)
+        q_block = scores[start:stop].astype(np.float64) * artifact["scale"]
+        rows = np.arange(len(ref_block))
+        ref_block[rows, start + rows] = -np.inf
+        q_block[rows, start + rows] = -np.inf
+        ref_top = np.argsort(-ref_block, axis=1, kind="stable")[:, :top_n]
+        q_top = np.argsort(-q_block, axis=1, kind="stable")[:, :top_n]
+        overlap += sum(len(set(a) & set(b)) for a, b in zip(ref_top, q_top))
+        total += ref_top.size
+    return overlap / total if total else 1.0
+
+
+def build_similarity_artifact(similarity_df, dtype=SIMILARITY_DTYPE):
+    artifact = quantize_similarity(similarity_df, dtype)
+    artifact["top5_agreement"] = ranking_agreement(similarity_df, artifact)
+    return artifact
+
+
+def write_similarity(similarity_df, path, dtype=SIMILARITY_DTYPE, compress=SIMILARITY_COMPRESS):
+    artifact = build_similarity_artifact(similarity_df, dtype)
+    joblib.dump(artifact, path, compress=compress)
+    return artifact["top5_agreement"]
+
+
+class QuantizedSimilarity:
+    """Read-only view over a quantized similarity artifact.
+
+    Exposes the part of the DataFrame API the app relies on (`columns`,
+    `index` and `similarity_df[product]`), dequantizing one column per lookup.
+    """
+
+    def __init__(self, artifact):
+        self.columns = self.index = pd.Index(artifact["labels"])
+        self.dtype = artifact["dtype"]
+        self.agreement = artifact.get("top5_agreement")
+        self._scores = artifact["scores"]
+        self._scale = artifact["scale"]
+
+    def __getitem__(self, product):
+        row = self._scores[self.columns.get_loc(product)]
+        scores = row.astype(np.promote_types(row.dtype, np.float32)) * self._scale
+        return pd.Series(scores, index=self.index, name=product)
+
+
+def read_similarity(path, mmap=SIMILARITY_COMPRESS == 0):
+    artifact = joblib.load(path, mmap_mode="r" if mmap else None)
+    # Artifacts written before quantization are plain float64 DataFrames.
+    if isinstance(artifact, pd.DataFrame):
+        return artifact
+    return QuantizedSimilarity(artifact)
+
+
+def recommend_products(product_name, similarity_df, top_n=5):
+    if product_name not in similarity_df.columns:
+        return None
+    # Drop the product by label, not position: a quantized score can tie with
+    # its self-score. Stable sorting keeps ties in catalog order.
+    scores = similarity_df[product_name].drop(product_name)
+    scores = scores.sort_values(ascending=False, kind="stable")
+    return scores.iloc[:top_n].index.tolist()
+
+
+def market_file(country, out_dir):
+    # The hash keeps names that slugify alike (or to nothing) apart.
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", str(country)).strip("_").lower()
+    digest = hashlib.sha256(str(country).encode()).hexdigest()[:8]
+    return os.path.join(out_dir, f"{slug}-{digest}.pkl")
+
+
+def build_market_similarity(country, country_df, out_dir, dtype, compress):
+    # Runs inside a worker process: write the partition straight to disk so
+    # only the file path travels back to the parent.
+    similarity_df = compute_similarity(build_pivot_table(country_df))
+    path = market_file(country, out_dir)
+    write_similarity(similarity_df, path, dtype, compress)
+    return country, path
+
+
+# =====================================================
+# BUILD PIPELINE (CONTENT-HASHED STAGE CACHE)
+# =====================================================
+# Each stage's key hashes its name, this module's source, its parameters and
+# upstream keys (ingest hashes the raw CSV bytes), so only stages whose inputs
+# changed re-run.
+DATA_FILE = "online_retail.csv"
+STAGE_CACHE_DIR = ".stage_cache"
+
+SEGMENT_LABELS = {
+    0: "Champions",
+    1: "Loyal Customers",
+    2: "Potential Loyalists",
+    3: "At Risk",
+    4: "Hibernating"
+}
+
+
+def ingest_stage(path):
+    return pd.read_csv(path)
+
+
+def clean_stage(df):
+    return df.dropna(subset=["CustomerID", "Description", "Quantity"])
+
+
+def pivot_stage(df):
+    return build_pivot_table(df)
+
+
+def similarity_stage(pivot_table, dtype):
+    return build_similarity_artifact(compute_similarity(pivot_table), dtype)
+
+
+def market_similarity_stage(df, dtype, compress, stage_dir):
+    # Market partitions live next to the cached index they belong to.
+    os.makedirs(stage_dir, exist_ok=True)
+    markets = joblib.Parallel(n_jobs=-1)(
+        joblib.delayed(build_market_similarity)(country, country_df, stage_dir, dtype, compress)
+        for country, country_df in df.groupby("Country")
+    )
+    return dict(markets)
+
+
+def rfm_stage(df):
+    df = df.copy()
+    df["InvoiceDate"] = pd.to_datetime(df["InvoiceDate"])
+
+    rfm = df.groupby("CustomerID").agg({
+        "InvoiceDate": lambda x: (df["InvoiceDate"].max() - x.max()).days,
+        "InvoiceNo": "count",
+        "Quantity": "sum"
+    })
+
+    rfm.columns = ["Recency", "Frequency", "Monetary"]
+    return rfm
+
+
+def scale_stage(rfm):
+    return StandardScaler().fit(rfm)
+
+
+def cluster_stage(rfm, scaler, n_clusters, random_state):
+    kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+    kmeans.fit(scaler.transform(rfm))
+    return kmeans
+
+
+def segment_stage(kmeans, labels):
+    # Only clusters the fitted model can predict get a label; the app maps
+    # anything else to "Unknown".
+    return {cluster: labels[cluster] for cluster in range(kmeans.n_clusters) if cluster in labels}
+
+
+def pipeline_stages(partition_by_country=PARTITION_BY_COUNTRY):
+    # Insertion order is a valid topological order of the DAG.
+    stages = {
+        # ingest/clean stay in memory: the CSV digest already keys everything
+        # downstream, so pickling the raw frames again would only cost disk.
+        "ingest": {"run": ingest_stage, "deps": (), "params": {"path": DATA_FILE}, "cache": False},
+        "clean": {"run": clean_stage, "deps": ("ingest",), "params": {}, "cache": False},
+        "pivot": {"run": pivot_stage, "deps": ("clean",), "params": {}},
+        "similarity": {
+            "run": similarity_stage,
+            "deps": ("pivot",),
+            "params": {"dtype": SIMILARITY_DTYPE},
+            "compress": SIMILARITY_COMPRESS
+        },
+        "rfm": {"run": rfm_stage, "deps": ("ingest",), "params": {}},
+        "scale": {"run": scale_stage, "deps": ("rfm",), "params": {}},
+        "cluster": {
+            "run": cluster_stage,
+            "deps": ("rfm", "scale"),
+            "params": {"n_clusters": 5, "random_state": 42}
+        },
+        "segments": {
+            "run": segment_stage,
+            "deps": ("cluster",),
+            "params": {"labels": SEGMENT_LABELS}
+        }
+    }
+    if partition_by_country:
+        stages["similarity"] = {
+            "run": market_similarity_stage,
+            "deps": ("clean",),
+            "params": {"dtype": SIMILARITY_DTYPE, "compress": SIMILARITY_COMPRESS},
+            "writes_files": True
+        }
+        # Nothing reads the catalog-wide pivot in this mode; never build it.
+        del stages["pivot"]
+    return stages
+
+
+def published_files(partition_by_country=PARTITION_BY_COUNTRY):
+    files = {
+        "kmeans_rfm_model.pkl": "cluster",
+        "rfm_scaler.pkl": "scale",
+        "segment_map.pkl": "segments"
+    }
+    if partition_by_country:
+        files[SIMILARITY_INDEX_FILE] = "similarity"
+    else:
+        files["pivot_table.pkl"] = "pivot"
+        files["similarity_df.pkl"] = "similarity"
+    return files
+
+
+def temp_path(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def dump_atomic(obj, path, compress=0):
+    tmp_path = temp_path(path)
+    joblib.dump(obj, tmp_path, compress=compress)
+    os.replace(tmp_path, path)
+
+
+def link_atomic(src, dst):
+    # Cache entries are never rewritten in place, so a hard link is safe and
+    # avoids a second copy of dense matrices; copy only across filesystems
+    # or where links are unsupported.
+    tmp_path = temp_path(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def publish(target, stage_path):
+    # Readers may be loading the old file; swap it in with os.replace.
+    if target != SIMILARITY_INDEX_FILE:
+        link_atomic(stage_path, target)
+        return
+
+    # Market partitions are linked out of the private stage cache so the
+    # published index never points into it.
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+    index = {}
+    for country, path in joblib.load(stage_path).items():
+        index[country] = os.path.join(PARTITION_DIR, os.path.basename(path))
+        link_atomic(path, index[country])
+    dump_atomic(index, target)
+
+    published = {os.path.basename(path) for path in index.values()}
+    for name in os.listdir(PARTITION_DIR):
+        if name not in published:
+            os.remove(os.path.join(PARTITION_DIR, name))
+
+
+def is_published(target):
+    if not os.path.exists(target):
+        return False
+    if target == SIMILARITY_INDEX_FILE:
+        return all(os.path.exists(path) for path in joblib.load(target).values())
+    return True
+
+
+def file_digest(path):
+    # Re-hash the CSV only when its size or mtime changed since the last run.
+    stat = os.stat(path)
+    stamp_file = os.path.join(STAGE_CACHE_DIR, "ingest.stamp")
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    if os.path.exists(stamp_file):
+        cached_stamp, digest = joblib.load(stamp_file)
+        if cached_stamp == stamp:
+            return digest
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    dump_atomic((stamp, digest), stamp_file)
+    return digest
+
+
+def code_digest():
+    # Stage functions are thin wrappers over helpers in this module, so any
+    # edit to the module invalidates every stage rather than guessing which.
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def stage_keys(stages):
+    keys = {}
+    code = code_digest()
+    for name, stage in stages.items():
+        sha = hashlib.sha256(name.encode())
+        sha.update(code.encode())
+        sha.update(repr(sorted(stage["params"].items())).encode())
+        sha.update(repr(stage.get("compress", 0)).encode())
+        if name == "ingest":
+            sha.update(file_digest(stage["params"]["path"]).encode())
+        for dep in stage["deps"]:
+            sha.update(keys[dep].encode())
+        keys[name] = sha.hexdigest()[:16]
+    return keys
+
+
+def stage_file(name, key):
+    return os.path.join(STAGE_CACHE_DIR, f"{name}-{key}.pkl")
+
+
+def run_pipeline(stages, keys, targets):
+    locks = {name: threading.Lock() for name in stages}
+    outputs = {}
+
+    def load(name):
+        path = resolve(name)
+        with locks[name]:
+            if name not in outputs:
+                outputs[name] = joblib.load(path)
+            return outputs[name]
+
+    def resolve(name):
+        # Fresh stages are never loaded unless a stale dependent needs them.
+        # Uncached stages have no path and only live in `outputs`.
+        stage = stages[name]
+        path = stage_file(name, keys[name]) if stage.get("cache", True) else None
+
+        def fresh():
+            return name in outputs or (path is not None and os.path.exists(path))
+
+        with locks[name]:
+            if fresh():
+                return path
+        inputs = [load(dep) for dep in stage["deps"]]
+        with locks[name]:
+            if not fresh():
+                params = dict(stage["params"])
+                if stage.get("writes_files"):
+                    params["stage_dir"] = os.path.join(STAGE_CACHE_DIR, f"{name}-{keys[name]}")
+                outputs[name] = stage["run"](*inputs, **params)
+                if path is not None:
+                    dump_atomic(outputs[name], path, stage.get("compress", 0))
+        return path
+
+    # Independent branches (similarity vs. RFM/cluster) build concurrently.
+    with ThreadPoolExecutor() as pool:
+        return dict(zip(targets, pool.map(resolve, targets)))
+
+
+def prune_stage_cache(keys):
+    # Drop outputs of superseded keys; dense pivots and similarity matrices
+    # would otherwise pile up with every data or parameter change.
+    keep = {"manifest.pkl", "ingest.stamp"}
+    for name, key in keys.items():
+        keep.add(f"{name}-{key}")
+        keep.add(os.path.basename(stage_file(name, key)))
+    for entry in os.listdir(STAGE_CACHE_DIR):
+        if entry in keep:
+            continue
+        path = os.path.join(STAGE_CACHE_DIR, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def manifest_file():
+    return os.path.join(STAGE_CACHE_DIR, "manifest.pkl")
+
+
+def stale_artifacts(partition_by_country=PARTITION_BY_COUNTRY):
+    os.makedirs(STAGE_CACHE_DIR, exist_ok=True)
+    keys = stage_keys(pipeline_stages(partition_by_country))
+    manifest = joblib.load(manifest_file()) if os.path.exists(manifest_file()) else {}
+    return {
+        target: stage
+        for target, stage in published_files(partition_by_country).items()
+        if manifest.get(target) != keys[stage] or not is_published(target)
+    }
+
+
+# One build at a time per process: Streamlit sessions share this module, so
+# concurrent reruns wait here instead of each running the whole DAG.
+_build_lock = threading.Lock()
+
+
+def build_artifacts(partition_by_country=PARTITION_BY_COUNTRY):
+    """Rebuild and publish stale artifacts; return True if anything changed."""
+    with _build_lock:
+        # Re-check under the lock: another session may have just rebuilt.
+        stale = stale_artifacts(partition_by_country)
+        if not stale:
+            return False
+
+        stages = pipeline_stages(partition_by_country)
+        keys = stage_keys(stages)
+        manifest = joblib.load(manifest_file()) if os.path.exists(manifest_file()) else {}
+        paths = run_pipeline(stages, keys, sorted(set(stale.values())))
+        for target, stage in stale.items():
+            publish(target, paths[stage])
+            manifest[target] = keys[stage]
+        dump_atomic(manifest, manifest_file())
+        prune_stage_cache(keys)
+        return True
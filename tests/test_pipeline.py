@@ -0,0 +1,175 @@
+import os
+import threading
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline
+
+# ingest and clean are recomputed in memory and never written to the cache.
+CACHED_STAGES = {"pivot", "similarity", "rfm", "scale", "cluster", "segments"}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    n = 400
+    pd.DataFrame({
+        "InvoiceNo": rng.integers(1, 100, n),
+        "Description": [f"PRODUCT {i}" for i in rng.integers(0, 20, n)],
+        "Quantity": rng.integers(1, 10, n),
+        "InvoiceDate": pd.Timestamp("2011-01-01") + pd.to_timedelta(rng.integers(0, 300, n), "D"),
+        "CustomerID": rng.integers(1, 40, n).astype(float),
+        "Country": rng.choice(["United Kingdom", "EIRE", "France"], n)
+    }).to_csv(tmp_path / "retail.csv", index=False)
+
+    # Published artifacts are written relative to the working directory.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, "DATA_FILE", str(tmp_path / "retail.csv"))
+    monkeypatch.setattr(pipeline, "STAGE_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path
+
+
+def cached_stages():
+    return {
+        entry.rsplit("-", 1)[0]
+        for entry in os.listdir(pipeline.STAGE_CACHE_DIR)
+        if entry.endswith(".pkl") and entry != "manifest.pkl"
+    }
+
+
+def build_and_report(**kwargs):
+    # A stage runs only when its keyed cache file is missing, so the files
+    # that appear during a build are exactly the stages that executed.
+    before = set(os.listdir(pipeline.STAGE_CACHE_DIR)) if os.path.isdir(pipeline.STAGE_CACHE_DIR) else set()
+    rebuilt = pipeline.build_artifacts(**kwargs)
+    after = set(os.listdir(pipeline.STAGE_CACHE_DIR))
+    ran = {entry.rsplit("-", 1)[0] for entry in after - before if entry.endswith(".pkl") and entry != "manifest.pkl"}
+    return rebuilt, ran
+
+
+def test_first_build_runs_every_stage(workdir):
+    rebuilt, ran = build_and_report(partition_by_country=False)
+
+    assert rebuilt
+    assert ran == CACHED_STAGES
+    for target in pipeline.published_files(False):
+        assert os.path.exists(target)
+
+
+def test_published_artifacts_share_storage_with_the_cache(workdir):
+    build_and_report(partition_by_country=False)
+    keys = pipeline.stage_keys(pipeline.pipeline_stages(False))
+
+    for target, stage in pipeline.published_files(False).items():
+        assert os.path.samefile(target, pipeline.stage_file(stage, keys[stage]))
+    assert not {"ingest", "clean"} & cached_stages()
+
+
+def test_second_build_is_a_no_op(workdir):
+    build_and_report(partition_by_country=False)
+
+    assert pipeline.stale_artifacts(False) == {}
+    assert build_and_report(partition_by_country=False) == (False, set())
+
+
+def test_kmeans_change_reruns_only_cluster_and_segments(workdir, monkeypatch):
+    build_and_report(partition_by_country=False)
+
+    stages = pipeline.pipeline_stages
+
+    def with_four_clusters(*args, **kwargs):
+        result = stages(*args, **kwargs)
+        result["cluster"]["params"] = {**result["cluster"]["params"], "n_clusters": 4}
+        return result
+
+    monkeypatch.setattr(pipeline, "pipeline_stages", with_four_clusters)
+
+    assert build_and_report(partition_by_country=False) == (True, {"cluster", "segments"})
+    assert joblib.load("kmeans_rfm_model.pkl").n_clusters == 4
+    assert sorted(joblib.load("segment_map.pkl")) == [0, 1, 2, 3]
+
+
+def test_deleted_artifact_is_restored_from_cache(workdir):
+    build_and_report(partition_by_country=False)
+    os.remove("similarity_df.pkl")
+
+    assert build_and_report(partition_by_country=False) == (True, set())
+    assert os.path.exists("similarity_df.pkl")
+
+
+def test_dtype_change_reruns_similarity_and_prunes_old_output(workdir, monkeypatch):
+    build_and_report(partition_by_country=False)
+    monkeypatch.setattr(pipeline, "SIMILARITY_DTYPE", "int8")
+
+    assert build_and_report(partition_by_country=False) == (True, {"similarity"})
+    assert pipeline.read_similarity("similarity_df.pkl").dtype == "int8"
+    assert sorted(cached_stages()) == sorted(CACHED_STAGES)
+
+
+def test_data_change_reruns_every_cached_stage(workdir):
+    build_and_report(partition_by_country=False)
+    with open(pipeline.DATA_FILE, "a") as f:
+        f.write("999,PRODUCT 0,3,2011-12-01,1.0,France\n")
+
+    assert build_and_report(partition_by_country=False) == (True, CACHED_STAGES)
+
+
+def test_partitioned_build_publishes_markets_outside_cache(workdir):
+    rebuilt, ran = build_and_report(partition_by_country=True)
+
+    assert rebuilt
+    assert ran == CACHED_STAGES - {"pivot"}
+    assert not os.path.exists("pivot_table.pkl")
+
+    index = joblib.load(pipeline.SIMILARITY_INDEX_FILE)
+    assert set(index) == {"United Kingdom", "EIRE", "France"}
+    for path in index.values():
+        assert os.path.dirname(path) == pipeline.PARTITION_DIR
+        assert os.path.exists(path)
+
+
+def test_concurrent_builds_run_the_dag_once(workdir):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(pipeline.build_artifacts(partition_by_country=False)))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False, True]
+
+
+@pytest.mark.parametrize("first, second", [("EIRE", "Eire"), ("Côte d'Ivoire", "Cote d Ivoire"), ("???", "!!!")])
+def test_market_files_stay_distinct(first, second):
+    assert pipeline.market_file(first, "out") != pipeline.market_file(second, "out")
+    assert not os.path.basename(pipeline.market_file("???", "out")).startswith(".")
+
+
+def test_deleted_partition_is_restored_from_cache(workdir):
+    build_and_report(partition_by_country=True)
+    index = joblib.load(pipeline.SIMILARITY_INDEX_FILE)
+    os.remove(index["France"])
+
+    assert pipeline.stale_artifacts(True) == {pipeline.SIMILARITY_INDEX_FILE: "similarity"}
+    assert build_and_report(partition_by_country=True) == (True, set())
+    assert os.path.exists(index["France"])
+
+
+def test_partitions_hold_only_their_market_products(workdir):
+    with open(pipeline.DATA_FILE, "a") as f:
+        f.write("998,FRENCH ONLY,2,2011-06-01,3.0,France\n")
+        f.write("998,PRODUCT 0,1,2011-06-01,3.0,France\n")
+    build_and_report(partition_by_country=True)
+    index = joblib.load(pipeline.SIMILARITY_INDEX_FILE)
+    df = pd.read_csv(pipeline.DATA_FILE).dropna(subset=["CustomerID", "Description", "Quantity"])
+
+    for country, path in index.items():
+        products = set(df.loc[df["Country"] == country, "Description"])
+        assert set(pipeline.read_similarity(path).columns) == products
+        assert ("FRENCH ONLY" in products) == (country == "France")
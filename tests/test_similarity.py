@@ -0,0 +1,90 @@
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline
+
+
+@pytest.fixture
+def similarity_df():
+    # Sparse, like real baskets: most customers never buy most products.
+    rng = np.random.default_rng(0)
+    pivot_table = pd.DataFrame(
+        rng.integers(1, 10, (200, 30)) * (rng.random((200, 30)) < 0.2),
+        columns=[f"PRODUCT {i}" for i in range(30)]
+    )
+    return pipeline.compute_similarity(pivot_table)
+
+
+def write_and_read(similarity_df, tmp_path, dtype, compress=0):
+    path = str(tmp_path / f"similarity_{dtype}.pkl")
+    pipeline.write_similarity(similarity_df, path, dtype, compress)
+    return pipeline.read_similarity(path, mmap=compress == 0)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_dequantized_columns_stay_within_half_a_step(similarity_df, tmp_path, dtype):
+    quantized = write_and_read(similarity_df, tmp_path, dtype)
+    # float16 has a 2**-10 step just below 1.0; int8 steps by the stored scale.
+    half_step = 2 ** -11 if dtype == "float16" else quantized._scale / 2
+
+    for product in similarity_df.columns:
+        error = np.abs(quantized[product].to_numpy() - similarity_df[product].to_numpy())
+        assert error.max() <= half_step + 1e-9
+
+
+def test_float64_agreement_is_exact(similarity_df):
+    artifact = pipeline.quantize_similarity(similarity_df, "float64")
+
+    assert pipeline.ranking_agreement(similarity_df, artifact) == 1.0
+
+
+def test_float16_keeps_every_top5(similarity_df, tmp_path):
+    quantized = write_and_read(similarity_df, tmp_path, "float16")
+
+    assert quantized.agreement == 1.0
+    for product in similarity_df.columns:
+        assert pipeline.recommend_products(product, quantized) == pipeline.recommend_products(product, similarity_df)
+
+
+def test_agreement_matches_what_recommend_products_returns(tmp_path):
+    # Near-duplicates tie with the product's own score once scaled to int8,
+    # so "drop the first result" would drop the wrong product.
+    rng = np.random.default_rng(1)
+    base = rng.random((100, 3))
+    pivot_table = pd.DataFrame(
+        np.hstack([base, base * 1.0001, rng.random((100, 10))]),
+        columns=[f"PRODUCT {i}" for i in range(16)]
+    )
+    similarity_df = pipeline.compute_similarity(pivot_table)
+    quantized = write_and_read(similarity_df, tmp_path, "int8")
+
+    overlap = sum(
+        len(set(pipeline.recommend_products(p, quantized)) & set(pipeline.recommend_products(p, similarity_df)))
+        for p in similarity_df.columns
+    )
+    assert quantized.agreement == pytest.approx(overlap / (len(similarity_df.columns) * 5))
+    for product in similarity_df.columns:
+        assert product not in pipeline.recommend_products(product, quantized)
+
+
+def test_legacy_float64_dataframe_still_loads(similarity_df, tmp_path):
+    path = str(tmp_path / "similarity_df.pkl")
+    joblib.dump(similarity_df, path)
+
+    loaded = pipeline.read_similarity(path)
+
+    assert isinstance(loaded, pd.DataFrame)
+    pd.testing.assert_frame_equal(loaded, similarity_df)
+
+
+def test_compressed_artifacts_load_without_mmap(similarity_df, tmp_path):
+    path = str(tmp_path / "compressed.pkl")
+    pipeline.write_similarity(similarity_df, path, "int8", compress=3)
+    compressed = pipeline.read_similarity(path, mmap=False)
+    mapped = write_and_read(similarity_df, tmp_path, "int8")
+
+    assert not isinstance(compressed._scores, np.memmap)
+    assert isinstance(mapped._scores, np.memmap)
+    np.testing.assert_array_equal(compressed._scores, mapped._scores)